@@ -2,22 +2,105 @@ import argparse
 import json
 import os
 import logging
+import math
 import sys
 from sklearn import covariance
-from collections import Counter
-from multiprocessing import Pool
-from functools import partial
 
 import pandas as pd
 import numpy as np
+from joblib import Parallel, delayed
 from scipy.stats import norm
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from Python import data, graph, mle
 
+try:
+    import pyarrow  # noqa: F401
+    adj_csv_engine = 'pyarrow'  # multi-threaded parser, used for the adjacency matrix if available
+except ImportError:
+    adj_csv_engine = 'c'
+
+try:
+    import orjson  # faster JSON serialization of the output and node ranks, if available
+except ImportError:
+    orjson = None
+
 cpu_count = os.cpu_count()
 
+# Parameters of the probability diffusion used for node ranks
+p1 = 1.0  # probability distributed between network nodes based on connectivity
+threshold_diff = 0.01  # diffusion returns up the call stack when exchanging this amount or less
+
+
+def write_json(obj, fname):
+
+    """
+    Write JSON file
+
+    Serialize with orjson if it is installed, otherwise with json. Both use a 2-space indent, the only one supported
+    by orjson, and convert non-string keys to strings.
+
+    Parameters
+    ----------
+    obj : The object to serialize.
+    fname : Name of the output JSON file.
+
+    """
+
+    if orjson:
+        with open(fname, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY |
+                                 orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(fname, 'w') as f:
+            json.dump(obj, f, indent=2)
+
+
+def read_experimental(fname, patients=None):
+
+    """
+    Read experimental dataset
+
+    Read z-scores of experimental samples, with metabolites as rows and samples as columns. If patients are given,
+    only their columns are parsed.
+
+    Parameters
+    ----------
+    fname : Experimental dataset file name.
+    patients : A list of column names of the samples to read. All samples are read by default.
+
+    Returns
+    -------
+    experimental_df : Data matrix with metabolites as rows and the selected samples as columns.
+
+    """
+
+    if not patients:
+        return pd.read_csv(fname, index_col=0)
+
+    header = pd.read_csv(fname, nrows=0).columns.tolist()
+    missing = [pt for pt in patients if pt not in header]
+    if missing:
+        raise ValueError(f'Patients {missing} not in {fname}.')
+
+    # Files written by R have no header field for the row names, so rows have one more field than the header and
+    # columns have to be selected by position
+    if len(pd.read_csv(fname, nrows=1, index_col=0).columns) == len(header):
+        usecols = sorted(header.index(pt) + 1 for pt in patients)
+        experimental_df = pd.read_csv(fname, header=None, skiprows=1, usecols=[0] + usecols, index_col=0)
+        experimental_df.columns = [header[i - 1] for i in usecols]
+        experimental_df.index.name = None
+    else:
+        experimental_df = pd.read_csv(fname, usecols=[header[0]] + patients, index_col=0)
+
+    return experimental_df[patients]
+
+
 p = argparse.ArgumentParser(description="Connect The Dots - Find the most connected subgraph")
 p.add_argument("--experimental", help="Experimental dataset file name.",
                default='')
+p.add_argument("--patients", help="Comma-separated list of experimental dataset columns (patients) to use. Only these "
+                                   "columns are read. All columns are used by default.", default='')
 p.add_argument("--control", help="Control dataset file name.", default='')  # data/example_argininemia/control.csv
 p.add_argument("--adj_matrix", help="CSV with adjacency matrix.", default='')  # data/example_argininemia/adj.csv
 p.add_argument("--s_module",
@@ -32,6 +115,8 @@ p.add_argument("--kmx", help="Number of highly perturbed nodes to consider. Igno
 p.add_argument("--present_in_perc_for_s",
                help="Percentage of patients having metabolite for selection of S module. Ignored if S module is given.",
                default=0.5, type=float)
+p.add_argument("--graphlasso_alpha", help="Regularization parameter of the graphical lasso used to learn the graph "
+                                         "when no adjacency matrix is given.", default=0.5, type=float)
 p.add_argument("--output_name", help="Name of the output JSON file.")
 p.add_argument("--out_graph_name", help="Name of the output graph adjacency CSV file.")
 p.add_argument("--num_processes", help="Number of worker processes to use for parallelisation. Default is to use the "
@@ -50,7 +135,12 @@ if __name__ == '__main__':
 
     # Read input dataframe with experimental (positive, disease) samples
     if os.path.exists(argv.experimental):
-        experimental_df = pd.read_csv(argv.experimental, index_col=0)
+        patients = [pt.strip() for pt in argv.patients.split(',')] if argv.patients else None
+        try:
+            experimental_df = read_experimental(argv.experimental, patients=patients)
+        except ValueError as e:
+            logging.debug('Patients given with --patients must be columns of the experimental dataset.')
+            raise e
         try:
             control_data = pd.read_csv(argv.control, index_col=0)
         except FileNotFoundError as e:
@@ -66,18 +156,47 @@ if __name__ == '__main__':
         # (i.e., networks with less edges) and in faster time.
 
         experimental_df = data.surrogate_profiles(data=experimental_df, ref_data=control_data, std=1)
+
+        # Values and metabolite names of the experimental matrix as ndarrays, with the z-scores of the target patients
+        # laid out with one row per patient, which is how pandas stores the columns
+        exp_vals = experimental_df.to_numpy(copy=False)
+        exp_idx = experimental_df.index.to_numpy()
+        col_to_pos = {col: i for i, col in enumerate(experimental_df.columns)}
+        pt_vals = exp_vals.T[[col_to_pos[pt] for pt in target_patients]]
     else:
         target_patients = []
 
     # Read input graph (adjacency matrix)
     if os.path.exists(argv.adj_matrix):
-        adj_df = pd.read_csv(argv.adj_matrix)  # keep as DataFrame for now
+        adj_df = pd.read_csv(argv.adj_matrix, engine=adj_csv_engine, dtype=np.float64)  # keep as DataFrame for now
         adj_df.index = adj_df.columns
     else:
         logging.debug('Starting graphical lasso.')
 
-        sample_cov = np.cov(experimental_df, bias=False)
-        _, icov = covariance.graphical_lasso(sample_cov, alpha=0.5)
+        # Unbiased sample covariance of metabolites (rows), computed as X X^T / (N - 1) - N / (N - 1) * mu mu^T to
+        # avoid the centered copy of the data made by np.cov. This loses precision when metabolite means are large
+        # compared to their variance, which is not the case for z-scores.
+        X = np.ascontiguousarray(experimental_df.to_numpy(dtype=np.float64))
+        N = X.shape[1]
+        fact = N - 1
+        mu = X.mean(axis=1, keepdims=True)
+        sample_cov = (X @ X.T) / fact - (N / fact) * (mu @ mu.T)
+
+        # Metabolites whose absolute covariance with all others is below alpha end up disconnected in the graphical
+        # lasso solution, so the problem splits into independent blocks given by the connected components of the
+        # thresholded covariance. Each block is solved separately; single-node blocks have no edges and are skipped.
+        mask = np.abs(sample_cov) > argv.graphlasso_alpha
+        np.fill_diagonal(mask, True)
+        n_comp, labels = connected_components(csr_matrix(mask), directed=False)
+        icov = np.zeros_like(sample_cov)
+        for comp in range(n_comp):
+            idx = np.where(labels == comp)[0]
+            if len(idx) < 2:
+                continue
+            # Coordinate descent is the faster solver for sparse blocks; it starts from the block's own covariance
+            _, sub_icov = covariance.graphical_lasso(sample_cov[np.ix_(idx, idx)], alpha=argv.graphlasso_alpha,
+                                                     mode='cd', max_iter=100, tol=1e-4)
+            icov[np.ix_(idx, idx)] = sub_icov
         np.fill_diagonal(icov, 0)
         adj_df = pd.DataFrame(icov, columns=experimental_df.index, index=experimental_df.index)
 
@@ -85,26 +204,31 @@ if __name__ == '__main__':
             adj_df.to_csv(argv.out_graph_name, index=False)
 
     # The Encoding Process
-    G = {}
-    for v in adj_df.columns:
-        G[v] = 0.0
+    # Nodes of graph G, only used for membership checks and the number of nodes
+    G_set = set(adj_df.columns)
+    nG = len(G_set)
 
     # Choose node subset
     kmx = argv.kmx  # Maximum subset size to inspect
-    S_set = []
 
     if not argv.s_module:
-        for pt in target_patients:
-            temp = experimental_df.sort_values(by=pt, ascending=False)
-            S_patient = list(temp.index)[:kmx]
-            S_set += S_patient
-
-        # Created list containing top kmx metabolites for every target user
-        occurrences = Counter(S_set)
-
-        # Keep in the S module the metabolites perturbed in at least 50% patients
-        S_perturbed_nodes = [node for node in occurrences if
-                             occurrences[node] >= len(target_patients) * argv.present_in_perc_for_s]
+        S_perturbed_nodes = []
+        if target_patients:
+            # Select top kmx metabolites for all target patients at once instead of sorting every column. The sort is
+            # stable, so metabolites with tied z-scores keep their row order as with per-patient sorting.
+            pt_values = -pt_vals
+            k = min(kmx, pt_values.shape[1])
+            top = np.argsort(pt_values, axis=1, kind='stable')[:, :k]
+
+            # Row indices of top kmx metabolites for every target user, and the number of users having each of them
+            S_set = top.ravel()
+            occurrences = np.bincount(S_set, minlength=pt_values.shape[1])
+
+            # Keep in the S module the metabolites perturbed in at least 50% patients, in order of first occurrence
+            threshold = len(target_patients) * argv.present_in_perc_for_s
+            S_set = S_set[occurrences[S_set] >= threshold]
+            _, first_occurrence = np.unique(S_set, return_index=True)
+            S_perturbed_nodes = exp_idx[S_set[np.sort(first_occurrence)]].tolist()
     elif os.path.exists(argv.s_module):
         s_module_df = pd.read_csv(argv.s_module)
         S_perturbed_nodes = [str(node) for node in s_module_df.iloc[:, -1]]
@@ -114,10 +238,10 @@ if __name__ == '__main__':
     logging.debug('Selected perturbed nodes, S = {}'.format(S_perturbed_nodes))
 
     # Check if all nodes from the s_module are in graph
-    for node in S_perturbed_nodes:
-        if node not in G:
-            logging.debug('Node "{}" not in graph. Exiting program.'.format(node))
-            exit(1)
+    missing = set(S_perturbed_nodes) - G_set
+    if missing:
+        logging.debug('Nodes {} not in graph. Exiting program.'.format(sorted(missing)))
+        exit(1)
 
     # Walk through all the nodes in S module
     logging.debug('Get the single-node encoding node ranks starting from each node.')
@@ -128,23 +252,50 @@ if __name__ == '__main__':
             ranks = json.load(f)
     else:
         ranks = {}
-        # If num_processes is set to 1, standard for loop will be used instead of creating multiprocessing pool with a
-        # single process to avoid overhead
-        if argv.num_processes == 1:
-            for node in S_perturbed_nodes:
-                ranks[node], _ = graph.single_node_get_node_ranks(n=node, G=G, p1=1.0, threshold_diff=0.01, adj_mat=adj_df,
-                                                                  S=S_perturbed_nodes, num_misses=np.log2(len(G)),
-                                                                  verbose=argv.verbose)
+        # Plain float, so it is not rebuilt as a numpy scalar for every task
+        num_misses = math.log2(nG)
+
+        node_to_idx = {node: i for i, node in enumerate(adj_df.columns)}
+
+        if argv.verbose == 2:
+            # The pandas implementation is used to log the trace of every diffusion event and the progress
+            G = {node: 0.0 for node in adj_df.columns}
+
+            def rank_tasks():
+                for node in S_perturbed_nodes:
+                    yield delayed(graph.single_node_get_node_ranks)(n=node, G=G, p1=p1, threshold_diff=threshold_diff,
+                                                                    adj_mat=adj_df, S=S_perturbed_nodes,
+                                                                    num_misses=num_misses, verbose=argv.verbose)
+        else:
+            # Node ranks are computed by the compiled walker on the adjacency values, with nodes referred to by index.
+            # Edge weights are kept in float64, as near-tie probabilities can change the ranks with lower precision.
+            adj_arr = adj_df.to_numpy(dtype=np.float64)
+            S_idx_arr = np.array([node_to_idx[node] for node in S_perturbed_nodes], dtype=np.int64)
+
+            def rank_tasks():
+                for node in S_perturbed_nodes:
+                    logging.debug("Node ranking {} of {}.".format(node_to_idx[node] + 1, nG))
+                    yield delayed(graph.single_node_get_node_ranks_nb)(start_idx=node_to_idx[node], adj_arr=adj_arr,
+                                                                       S_idx_arr=S_idx_arr, p1=p1,
+                                                                       threshold_diff=threshold_diff,
+                                                                       num_misses=num_misses)
+
+        # No more worker processes than nodes to rank are needed. If there is a single process, standard for loop
+        # will be used instead of creating a pool of worker processes with a single process to avoid overhead
+        num_processes = min(argv.num_processes, max(1, len(S_perturbed_nodes)))
+        if num_processes <= 1:
+            ranks_collection = [func(*args, **kwargs) for func, args, kwargs in rank_tasks()]
         else:
-            pool = Pool(argv.num_processes)
-            ranks_collection = pool.map(partial(graph.single_node_get_node_ranks, G=G, p1=1.0, threshold_diff=0.01,
-                                                adj_mat=adj_df, S=S_perturbed_nodes, num_misses=np.log2(len(G)),
-                                                verbose=argv.verbose), S_perturbed_nodes)
-            pool.close()
-            pool.join()
+            # joblib dumps large arrays (such as the adjacency matrix) to a memmap once and workers open it read-only,
+            # instead of pickling the adjacency matrix to every worker for every task
+            with Parallel(n_jobs=num_processes, mmap_mode='r') as parallel:
+                ranks_collection = parallel(rank_tasks())
 
-            for tup in ranks_collection:
-                ranks[tup[1]] = tup[0]
+        for node, curr_ns in zip(S_perturbed_nodes, ranks_collection):
+            if argv.verbose == 2:
+                ranks[node] = curr_ns[0]
+            else:
+                ranks[node] = adj_df.columns[curr_ns].tolist()
 
     # Convert to bitstring
     # Get the bitstring associated with the disease module's metabolites
@@ -155,7 +306,8 @@ if __name__ == '__main__':
     # and z-values for each metabolite
 
     if os.path.exists(argv.experimental):
-        data_mx_pvals = experimental_df[target_patients].apply(lambda x: 2 * norm.sf(abs(x)))
+        data_mx_pvals = pd.DataFrame(2.0 * norm.sf(np.abs(pt_vals.T)), index=experimental_df.index,
+                                     columns=target_patients)
         # p-value is area under curve of normal distribution on the right of the
         # specified z-score. sf generates normal distribution with mean=0, std=1,
         # which is exactly what z-scores are
@@ -169,20 +321,15 @@ if __name__ == '__main__':
         pt_id = None
 
     # Returns a subset of nodes that are highly connected
-    res = mle.get_encoding_length(bs=pt_bs_by_k, G=G, pvals=data_mx_pvals.T, pt_id=pt_id)
-    ind_mx = np.where(res['d.score'] == res['d.score'].max())
-    highest_dscore_paths = res.iloc[ind_mx]
+    res = mle.get_encoding_length(bs=pt_bs_by_k, G=G_set, pvals=data_mx_pvals.T, pt_id=pt_id)
 
     # Locate encoding (F) with best d-score
     # Tiebreaker 1: If several results have the same d-score take one with longest BS
-    ind_F = np.where(highest_dscore_paths['optimalBS'].str.len() ==
-                     highest_dscore_paths['optimalBS'].str.len().max())
-    ind_F = highest_dscore_paths.iloc[ind_F]
-
     # Tiebreaker 2: Take the one with the largest subsetSize
-    index_highest = np.where(ind_F['subsetSize'] == ind_F['subsetSize'].max())
-    ind_F = ind_F.iloc[index_highest]
-    ind_F = ind_F.index.values[0]
+    # Remaining ties are broken by taking the first result, hence the decreasing position as the last key.
+    bs_len = np.fromiter((len(bs) for bs in res['optimalBS']), count=len(res), dtype=np.int64)
+    order = np.lexsort((-np.arange(len(res)), res['subsetSize'].to_numpy(), bs_len, res['d.score'].to_numpy()))
+    ind_F = int(order[-1])
     F_info = res.iloc[ind_F]
 
     # You can interpret the probability assigned to this metabolite set by
@@ -191,15 +338,17 @@ if __name__ == '__main__':
     # Significance theorem, we can estimate the upper bounds on a p-value by 2^-d.score.
 
     p_value_F = 2.0 ** (-1 * F_info['d.score'])
-    # All metabolites in the bitstring
-    logging.debug(f'All metabolites in the bitstring: {[d[0] for d in pt_bs_by_k[ind_F]]}')
+    bs_F = pt_bs_by_k[ind_F]
+    # All metabolites in the bitstring, only listed if debug logging is enabled
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f'All metabolites in the bitstring: {[d[0] for d in bs_F]}')
 
     # Just the F metabolites that are in S module that were were "found"
     keep_nodes = [1]
     if argv.include_not_in_s:
         keep_nodes = [0, 1]
 
-    Fs = [d[0] for d in pt_bs_by_k[ind_F] if d[1] in keep_nodes]
+    Fs = [d[0] for d in bs_F if d[1] in keep_nodes]
 
     logging.debug('Set of highly-connected perturbed metabolites F = {} with p-value = {}'.format(Fs, p_value_F))
 
@@ -212,7 +361,7 @@ if __name__ == '__main__':
         "p_value": p_value_F,
         "kmcm_probability": kmcm_probability,
         "optimal_bitstring": optimal_bitstring,
-        "number_of_nodes_in_G": len(G)
+        "number_of_nodes_in_G": nG
     }
 
     if not argv.output_name:
@@ -225,8 +374,5 @@ if __name__ == '__main__':
 
     outrname = outfname.replace('.json', '_ranks.json')
 
-    with open(outfname, 'w') as f:
-        json.dump(out_dict, f, indent=4)
-
-    with open(outrname, 'w') as f:
-        json.dump(ranks, f, indent=4)
+    write_json(out_dict, outfname)
+    write_json(ranks, outrname)
@@ -5,6 +5,7 @@ import igraph
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
+from numba import njit
 
 def net_walk_snap_shot(adj_mat, G, output_dir, visited_nodes, S, coords, img_num=1, use_labels=True):
 
@@ -400,3 +401,272 @@ def single_node_get_node_ranks(n, G, p1, threshold_diff, adj_mat, S=None, num_mi
                                img_num=len(curr_ns), use_labels=use_labels)
 
     return curr_ns, n
+
+
+@njit(cache=True, error_model='numpy')
+def get_unvisited_nbors_nb(start_idx, visited, adj_arr):
+
+    """
+    Unvisited neighbors of a node (compiled)
+
+    Find the unvisited neighbors of start_idx and the weights of their edges to it. If start_idx is stranded by visited
+    neighbors, it is connected to its unvisited "extended" neighbors as in connect_to_ext.
+
+    Parameters
+    ----------
+    start_idx : Index of the node most recently visited by the network walker.
+    visited : A boolean array marking the visited nodes.
+    adj_arr : The adjacency matrix that encodes the edge weights for the network, as a 2D array.
+
+    Returns
+    -------
+    nbors : An array of indices of the unvisited (extended) neighbors of start_idx, in network order.
+    weights : An array with the weights of the edges between start_idx and nbors.
+    extended : True if nbors are extended neighbors of start_idx.
+
+    """
+
+    n = adj_arr.shape[0]
+    is_nbor = np.zeros(n, dtype=np.bool_)
+    weights = np.zeros(n)
+    has_nbors = False
+    other_visited = False
+    for i in range(n):
+        if adj_arr[i, start_idx] != 0 and not visited[i]:
+            is_nbor[i] = True
+            weights[i] = adj_arr[i, start_idx]
+            has_nbors = True
+        if visited[i] and i != start_idx:
+            other_visited = True
+
+    extended = other_visited and not has_nbors
+    if extended:
+        for n1 in range(n):
+            if adj_arr[n1, start_idx] != 0:
+                for n2 in range(n):
+                    if not visited[n2] and adj_arr[n1, n2] != 0:
+                        is_nbor[n2] = True
+                        weights[n2] = adj_arr[n1, n2]
+
+    nbors = np.nonzero(is_nbor)[0]
+    return nbors, weights[nbors], extended
+
+
+@njit(cache=True, error_model='numpy')
+def diffuse_p1_nb(p1, start_idx, G, visited, num_visited, threshold_diff, adj_arr):
+
+    """
+    Diffuse Probability P1 from a starting node (compiled)
+
+    Array-based equivalent of diffuse_p1 compiled with numba. Nodes are referred to by their position in adj_arr and
+    G is updated in place. The recursion of diffuse_p1 is unrolled into an explicit stack of diffusion events.
+
+    Parameters
+    ----------
+    p1 : The probability being dispersed from the starting node.
+    start_idx : Index of the node most recently visited by the network walker, from which p1 gets dispersed.
+    G : An array of probabilities, one for each node in the network.
+    visited : A boolean array marking the visited nodes.
+    num_visited : Length of the history of previous draws in the node ranking sequence.
+    threshold_diff : When the probability diffusion algorithm exchanges this amount (threshold_diff) or less between
+    nodes, the algorithm returns up the call stack.
+    adj_arr : The adjacency matrix that encodes the edge weights for the network, as a 2D array.
+
+    Returns
+    -------
+
+    Examples
+    --------
+
+    """
+
+    n = adj_arr.shape[0]
+
+    nbors, weights, extended = get_unvisited_nbors_nb(start_idx, visited, adj_arr)
+    if not len(nbors):
+        for i in range(n):
+            if not visited[i]:
+                G[i] = G[i] + p1 / (n - num_visited)
+        return
+
+    # Each stack entry is a diffusion event from a start node that still has neighbors to send probability to
+    stack_start = [start_idx]
+    stack_p1 = [p1]
+    stack_num_visited = [num_visited]
+    stack_nbors = [nbors]
+    stack_weights = [weights]
+    stack_w_edges_sum = [weights.sum()]
+    stack_extended = [extended]
+    stack_pos = [0]
+
+    while stack_start:
+        top = len(stack_start) - 1
+        pos = stack_pos[top]
+
+        if pos == len(stack_nbors[top]):
+            # All neighbors were visited, return up the call stack
+            if top > 0:
+                visited[stack_start[top]] = False
+            stack_start.pop()
+            stack_p1.pop()
+            stack_num_visited.pop()
+            stack_nbors.pop()
+            stack_weights.pop()
+            stack_w_edges_sum.pop()
+            stack_extended.pop()
+            stack_pos.pop()
+            continue
+
+        stack_pos[top] = pos + 1
+        z = stack_nbors[top][pos]
+        i_prob = stack_p1[top] * abs(stack_weights[top][pos]) / stack_w_edges_sum[top]  # inherited prob
+        G[z] = G[z] + i_prob
+
+        # An extended neighbor is connected to the start node, otherwise check its column in the adjacency matrix
+        z_has_nbors = stack_extended[top]
+        if not z_has_nbors:
+            for i in range(n):
+                if adj_arr[i, z] != 0:
+                    z_has_nbors = True
+                    break
+
+        if z_has_nbors and i_prob / 2 > threshold_diff and stack_num_visited[top] + 1 < n:
+            G[z] = G[z] - i_prob / 2
+            visited[z] = True
+            z_nbors, z_weights, z_extended = get_unvisited_nbors_nb(z, visited, adj_arr)
+
+            if len(z_nbors):
+                stack_start.append(z)
+                stack_p1.append(i_prob / 2)
+                stack_num_visited.append(stack_num_visited[top] + 1)
+                stack_nbors.append(z_nbors)
+                stack_weights.append(z_weights)
+                stack_w_edges_sum.append(z_weights.sum())
+                stack_extended.append(z_extended)
+                stack_pos.append(0)
+            else:
+                for i in range(n):
+                    if not visited[i]:
+                        G[i] = G[i] + i_prob / 2 / (n - stack_num_visited[top] - 1)
+                visited[z] = False
+
+
+@njit(cache=True, error_model='numpy')
+def fixed_walk_nb(start_idx, adj_arr, S_idx_arr, p1, threshold_diff, num_misses):
+
+    """
+    Single-node "fixed" walk (compiled)
+
+    Array-based equivalent of single_node_get_node_ranks compiled with numba. Nodes are referred to by their position
+    in adj_arr.
+
+    Parameters
+    ----------
+    start_idx : Index of the node ranking you want to calculate.
+    adj_arr : The adjacency matrix that encodes the edge weights for the network, as a 2D array.
+    S_idx_arr : An array of indices of the nodes in the subset you want the network walker to find. If empty, all nodes
+    are ranked.
+    p1 : The probability that is preferentially distributed between network nodes by the probability diffusion algorithm
+    based solely on network connectivity. The remaining probability (i.e., "p0") is uniformly distributed between
+    network nodes, regardless of connectivity.
+    threshold_diff : When the probability diffusion algorithm exchanges this amount or less between nodes, the algorithm
+     returns up the call stack.
+    num_misses : The number of "misses" the network walker will tolerate before switching to fixed length codes for
+    remaining nodes to be found.
+
+    Returns
+    -------
+    curr_ns - An array of node indices in the order they were drawn by the probability diffusion algorithm.
+
+    Examples
+    --------
+
+    """
+
+    n = adj_arr.shape[0]
+    p0 = 1 - p1
+
+    in_S = np.zeros(n, dtype=np.bool_)
+    for i in S_idx_arr:
+        in_S[i] = True
+
+    visited = np.zeros(n, dtype=np.bool_)
+    visited[start_idx] = True
+    curr_ns = [start_idx]  # current node set
+    count_misses = 0
+
+    while True:
+        # set unvisited nodes to base_p
+        base_p = p0 / (n - len(curr_ns))
+        G = np.zeros(n)
+        for i in range(n):
+            if not visited[i]:
+                G[i] = base_p
+
+        diffuse_p1_nb(p1, start_idx, G, visited, len(curr_ns), threshold_diff, adj_arr)
+
+        # Sanity check - p1_event should add up to roughly 1
+        p1_event = 0.0
+        num_unvisited = 0
+        for i in range(n):
+            p1_event += G[i]
+            if not visited[i]:
+                num_unvisited += 1
+        if abs(p1_event - 1) > threshold_diff:
+            extra_prob_to_diffuse = 1 - p1_event
+            for i in range(n):
+                if visited[i]:
+                    G[i] = 0
+                else:
+                    G[i] = G[i] + extra_prob_to_diffuse / num_unvisited
+
+        # Set start_idx to the node with the max probability, when there are ties choose the first of the winners
+        start_idx = np.argmax(G)
+        curr_ns.append(start_idx)
+        visited[start_idx] = True
+
+        if len(S_idx_arr):  # draw until all members of S are found
+            if in_S[start_idx]:
+                count_misses = 0
+            else:
+                count_misses += 1
+
+            if count_misses > num_misses or not (in_S & ~visited).any():
+                break
+        elif len(curr_ns) >= n:
+            break
+
+    return np.array(curr_ns)
+
+
+def single_node_get_node_ranks_nb(start_idx, adj_arr, S_idx_arr, p1, threshold_diff, num_misses):
+
+    """
+    Generate single-node node rankings ("fixed" walk) from an adjacency array
+
+    Runs the compiled fixed_walk_nb. This is a plain Python function so that it is pickled by reference when sent to
+    worker processes, which then load the compiled walker from numba's cache instead of recompiling it.
+
+    Parameters
+    ----------
+    start_idx : Index of the node ranking you want to calculate.
+    adj_arr : The adjacency matrix that encodes the edge weights for the network, as a 2D array.
+    S_idx_arr : An array of indices of the nodes in the subset you want the network walker to find. If empty, all nodes
+    are ranked.
+    p1 : The probability that is preferentially distributed between network nodes by the probability diffusion algorithm
+    based solely on network connectivity.
+    threshold_diff : When the probability diffusion algorithm exchanges this amount or less between nodes, the algorithm
+     returns up the call stack.
+    num_misses : The number of "misses" the network walker will tolerate before switching to fixed length codes for
+    remaining nodes to be found.
+
+    Returns
+    -------
+    curr_ns - An array of node indices in the order they were drawn by the probability diffusion algorithm.
+
+    Examples
+    --------
+
+    """
+
+    return fixed_walk_nb(start_idx, adj_arr, S_idx_arr, p1, threshold_diff, num_misses)